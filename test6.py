@@ -1,20 +1,27 @@
 import os
 import io
+import math
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Union
+
 import streamlit as st
 from PIL import Image
-from reportlab.pdfgen import canvas
-from reportlab.lib.pagesizes import A4
-from reportlab.lib.utils import ImageReader
 
-# Optional: PDF -> Image
+# Optional: PDF -> Image (in-process rendering, no poppler subprocess)
 try:
-    from pdf2image import convert_from_bytes
-    PDF2IMAGE_OK = True
+    import pymupdf
+    PYMUPDF_OK = True
 except Exception:
-    PDF2IMAGE_OK = False
+    PYMUPDF_OK = False
 
-# macOS Homebrew poppler path (adjust if different)
-POPPLER_PATH = "/opt/homebrew/opt/poppler/bin"
+# Optional: SIMD-vectorized downscaling
+try:
+    import cv2
+    import numpy as np
+    CV2_OK = True
+except Exception:
+    CV2_OK = False
 
 st.set_page_config(page_title="Exact Size File Converter", layout="centered")
 st.title("📂 Exact Size File Converter")
@@ -23,179 +30,435 @@ st.write("Upload an **Image or PDF**, choose output type & target size (KB), the
 uploaded = st.file_uploader("Upload file", type=["jpg","jpeg","png","webp","bmp","tiff","pdf"])
 out_type = st.selectbox("Output type", ["jpg", "png", "webp", "pdf"])
 target_kb = st.number_input("Target size (KB)", min_value=10, max_value=5000, value=100)
+pad = st.checkbox("Pad to exact target size", value=False)
 run = st.button("Convert")
 
 KB = 1024
 TARGET_MIN_QUALITY = 10
 TARGET_MAX_QUALITY = 95
 
+@st.cache_resource(show_spinner=False)
+def _encode_pool() -> ThreadPoolExecutor:
+    """Encoding releases the GIL inside libjpeg/libwebp, so independent probe
+    encodes can run on separate cores. cache_resource keeps one pool per
+    process; a module global would be rebuilt (leaking threads) on every
+    Streamlit rerun since the script top level re-executes."""
+    return ThreadPoolExecutor(max_workers=os.cpu_count())
+
 # ----------------- helpers -----------------
-def pad_file_to_size_safe(data: bytes, target_bytes: int, is_pdf=False) -> bytes:
-    """Pad data to reach target size. Never truncate PDFs."""
+def pad_file_to_size_safe(data: bytes, target_bytes: int, is_pdf=False, pad=False) -> bytes:
+    """Pad data to reach target size (opt-in). Never truncate PDFs.
+
+    Padding is off by default: most consumers only care about <= target, and
+    filling a multi-MB gap costs a multi-MB allocation per conversion.
+    """
+    if not pad:
+        return data
     if len(data) >= target_bytes:
         return data if is_pdf else data[:target_bytes]
-    return data + b" " * (target_bytes - len(data))
+    out = bytearray(target_bytes)  # single preallocation, no concat chain
+    out[:len(data)] = data
+    return bytes(out)
+
+def prepare_for_jpeg(img: Image.Image) -> Image.Image:
+    """Flatten alpha / convert palette so the image is ready for JPEG encoding."""
+    if img.mode in ("RGBA", "LA", "P"):
+        bg = Image.new("RGB", img.size, (255, 255, 255))
+        try:
+            bg.paste(img, mask=img.split()[-1])
+        except Exception:
+            bg.paste(img)
+        return bg
+    if img.mode != "RGB":
+        return img.convert("RGB")
+    return img
+
+def encode_jpeg(rgb_img: Image.Image, quality: int, optimize: bool = False) -> io.BytesIO:
+    """Encode an already-RGB image as JPEG. Keep optimize off for search probes.
+
+    Returns the BytesIO rather than bytes: tell() gives the size for free,
+    and only winning candidates pay the getvalue() copy.
+    """
+    buf = io.BytesIO()
+    # progressive + 4:2:0 subsampling is ~15-25% smaller at the same quality
+    # number, so the search settles on a higher quality for the same target
+    rgb_img.save(buf, "JPEG", quality=quality, optimize=optimize,
+                 progressive=True, subsampling=2)
+    return buf
+
+def encode_webp(img: Image.Image, quality: int, method: int = 6) -> io.BytesIO:
+    buf = io.BytesIO()
+    img.save(buf, "WEBP", quality=quality, method=method)
+    return buf
+
+def _encode_webp_probe(img: Image.Image, quality: int) -> io.BytesIO:
+    """Probe encode: method=4 is 2-3x faster than the default effort and the
+    small ratio difference washes out once the winner is re-encoded."""
+    return encode_webp(img, quality, method=4)
+
+def estimate_quality(img: Image.Image, target_bytes: int, encode=encode_jpeg):
+    """Find a quality that fits target_bytes using a size-vs-quality model.
+
+    The JPEG rate-quality curve is close to log-linear per image, so two
+    probe encodes (q=30 and q=90) pin down the curve; one verify encode plus
+    at most one -5 correction then replaces a full binary search.
+    Returns (quality, BytesIO). If quality is None, even the floor quality
+    was too large and the buffer is a best-effort over target.
+    """
+    # The two calibration probes are independent; encode them in parallel.
+    # The threaded probe gets its own copy: Image.save stashes encoder state
+    # on the image itself, so two threads must never encode one instance.
+    future_hi = _encode_pool().submit(encode, img.copy(), 90)
+    probe_lo = encode(img, 30)
+    s30 = probe_lo.tell()
+    if s30 > target_bytes:
+        # q=90 can only be bigger; don't let the most expensive encode of
+        # the search run for a result nobody will read. cancel() usually
+        # wins because the pool hasn't started the probe yet.
+        future_hi.cancel()
+        # Below the calibrated range: refit the line between q=10 and q=30
+        # and extrapolate, rather than collapsing straight to the floor —
+        # a target just under the q=30 size still deserves q=29, not q=10.
+        floor = encode(img, TARGET_MIN_QUALITY)
+        s10 = floor.tell()
+        if s10 > target_bytes:
+            return None, floor
+        slope = (math.log(s30) - math.log(s10)) / (30 - TARGET_MIN_QUALITY)
+        quality = TARGET_MIN_QUALITY
+        if slope > 0:
+            quality = int(TARGET_MIN_QUALITY + (math.log(target_bytes) - math.log(s10)) / slope)
+        quality = max(TARGET_MIN_QUALITY, min(29, quality))
+        if quality == TARGET_MIN_QUALITY:
+            return TARGET_MIN_QUALITY, floor
+        candidate = encode(img, quality)
+        if candidate.tell() > target_bytes:
+            quality = max(TARGET_MIN_QUALITY, quality - 5)
+            candidate = encode(img, quality)
+        if candidate.tell() > target_bytes:
+            return TARGET_MIN_QUALITY, floor
+        return quality, candidate
+    probe_hi = future_hi.result()
+    s90 = probe_hi.tell()
+    if s90 <= target_bytes:
+        return 90, probe_hi
+    slope = (math.log(s90) - math.log(s30)) / 60.0
+    quality = 30
+    if slope > 0:
+        quality = int(30 + (math.log(target_bytes) - math.log(s30)) / slope)
+    quality = max(TARGET_MIN_QUALITY, min(TARGET_MAX_QUALITY, quality))
+    candidate = encode(img, quality)
+    if candidate.tell() > target_bytes:
+        quality = max(TARGET_MIN_QUALITY, quality - 5)
+        candidate = encode(img, quality)
+    if candidate.tell() > target_bytes:
+        # model missed twice; q=30 is a known-good fallback
+        return 30, probe_lo
+    return quality, candidate
+
+def _target_pixel_size(w: int, h: int, target_bytes: int):
+    """Size the pixel budget calls for, or None if the image is close enough.
+
+    JPEG at mid quality lands around 10 pixels per output byte, so an image
+    far above that budget spends every probe DCT-ing pixels the final file
+    cannot keep anyway. Only shrink clearly oversized images (>4x budget) and
+    keep 2x headroom so the quality search still has room to work.
+    """
+    pixel_budget = target_bytes * 10
+    pixels = w * h
+    if pixels > pixel_budget * 4:
+        s = math.sqrt(pixel_budget * 2 / pixels)
+        return max(int(w * s), 1), max(int(h * s), 1)
+    return None
+
+def _downscale(img: Image.Image, size) -> Image.Image:
+    """Resize down to `size`, box-decimating the integer part first.
+
+    For big (>2x) downscales cv2's INTER_AREA does the whole job in one
+    SIMD-vectorized C call with proper anti-aliasing. Otherwise Image.reduce
+    is a plain box filter in optimized C and much cheaper than LANCZOS
+    convolution for integer factors; a residual LANCZOS pass covers the
+    remainder, so quality matches a straight LANCZOS resize.
+    """
+    w, h = size
+    if CV2_OK and img.mode in ("L", "RGB", "RGBA") and w <= img.width // 2 and h <= img.height // 2:
+        arr = cv2.resize(np.asarray(img), (w, h), interpolation=cv2.INTER_AREA)
+        return Image.fromarray(arr)
+    if w < img.width and h < img.height and img.mode not in ("P", "1"):
+        factor = min(img.width // w, img.height // h)
+        if factor > 1:
+            img = img.reduce(factor)
+    if img.size != (w, h):
+        img = img.resize((w, h), Image.LANCZOS)
+    return img
+
+def choose_initial_size(img: Image.Image, target_bytes: int) -> Image.Image:
+    """Downscale once before the quality search starts."""
+    size = _target_pixel_size(img.width, img.height, target_bytes)
+    if size:
+        return _downscale(img, size)
+    return img
 
-def save_with_format(img: Image.Image, pil_format: str, quality: int = 90) -> bytes:
+def save_with_format(img: Image.Image, pil_format: str, quality: int = 90, final: bool = True) -> io.BytesIO:
+    """Encode img into a BytesIO (tell() = size; getvalue() only on winners).
+    final=False skips the optimize pass (PNG filter/DEFLATE search, JPEG
+    Huffman tables) for throwaway probe encodes."""
     buf = io.BytesIO()
     if pil_format == "JPEG":
-        if img.mode in ("RGBA", "LA", "P"):
-            bg = Image.new("RGB", img.size, (255, 255, 255))
-            try:
-                bg.paste(img, mask=img.split()[-1])
-            except Exception:
-                bg.paste(img)
-            img = bg
-        elif img.mode != "RGB":
-            img = img.convert("RGB")
-        img.save(buf, pil_format, quality=quality, optimize=True)
+        prepare_for_jpeg(img).save(buf, pil_format, quality=quality, optimize=final,
+                                   progressive=True, subsampling=2)
     elif pil_format == "WEBP":
         img.save(buf, pil_format, quality=quality)
     elif pil_format in ("PNG", "BMP", "TIFF"):
         try:
-            img.save(buf, pil_format, optimize=True)
+            img.save(buf, pil_format, optimize=final)
         except TypeError:
             img.save(buf, pil_format)
     else:
         img.save(buf, pil_format)
-    return buf.getvalue()
+    return buf
 
-def image_to_image_exact(data: bytes, out_fmt: str, target_bytes: int) -> bytes:
+@lru_cache(maxsize=4)
+def _load_pil_cached(data: bytes) -> Image.Image:
+    img = Image.open(io.BytesIO(data))
+    img.load()
+    return img
+
+def load_pil(data: bytes) -> Image.Image:
+    """Decode the upload once per process; shared by the Image->Image and
+    Image->PDF paths, so trying PDF then JPG on the same upload decodes once.
+
+    Returns a private copy: Image.save stashes encoder state on the image,
+    so the cached instance must never be encoded by two sessions at once.
+    The copy is a memcpy — trivial next to the decode it saves.
+    """
+    return _load_pil_cached(data).copy()
+
+def open_for_target(data: bytes, target_bytes: int) -> Image.Image:
+    """Decode the upload, downscaling oversized JPEGs inside the decoder.
+
+    For JPEG input Image.draft makes libjpeg decode straight to 1/2-1/8
+    resolution (IDCT scaling), never materialising the full-size pixel
+    buffer. Anything else comes from the shared load_pil cache; the residual
+    LANCZOS step is choose_initial_size's job either way.
+    """
+    probe = Image.open(io.BytesIO(data))  # lazy: reads the header only
+    if probe.format == "JPEG":
+        size = _target_pixel_size(probe.width, probe.height, target_bytes)
+        if size:
+            probe.draft("JPEG", size)
+            probe.load()
+            return probe
+    return load_pil(data)
+
+def _image_to_image_exact(src: Union[bytes, Image.Image], out_fmt: str, target_bytes: int, pad: bool = False) -> bytes:
+    """Conversion worker; src may be raw upload bytes or an already-decoded
+    PIL image (e.g. a freshly rendered PDF page)."""
     fmt_map = {"jpg": "JPEG", "jpeg": "JPEG", "png": "PNG", "webp": "WEBP", "bmp": "BMP", "tiff": "TIFF"}
     out_key = out_fmt.lower()
     if out_key not in fmt_map:
         raise ValueError("Unsupported output format: " + str(out_fmt))
     pil_format = fmt_map[out_key]
+    is_pil = isinstance(src, Image.Image)
 
-    img = Image.open(io.BytesIO(data))
-
-    # 1) Try high-quality save
-    out_bytes = save_with_format(img, pil_format, quality=90)
-    if len(out_bytes) <= target_bytes:
-        return pad_file_to_size_safe(out_bytes, target_bytes)
+    # 0) No-op case: the upload already is the requested format and fits the
+    # target. Image.open only reads the header here, so sniffing is free.
+    if not is_pil and len(src) <= target_bytes:
+        if Image.open(io.BytesIO(src)).format == pil_format:
+            return pad_file_to_size_safe(src, target_bytes, pad=pad)
 
-    # 2) Quality binary search (JPEG/WEBP)
+    # 1) Model-based quality search (JPEG/WEBP)
+    # Prepare the pixel buffer once; probes then only pay for DCT + entropy
+    # coding, and the Huffman optimize pass runs once on the winning quality.
     if pil_format in ("JPEG", "WEBP"):
-        low, high = TARGET_MIN_QUALITY, TARGET_MAX_QUALITY
-        best = None
-        while low <= high:
-            mid = (low + high) // 2
-            candidate = save_with_format(img, pil_format, quality=mid)
-            size = len(candidate)
-            if size <= target_bytes:
-                best = candidate
-                low = mid + 1
+        img = src if is_pil else open_for_target(src, target_bytes)
+        img = choose_initial_size(img, target_bytes)
+        if pil_format == "JPEG":
+            prepared = prepare_for_jpeg(img)
+            encode = encode_jpeg
+        else:
+            prepared = img
+            encode = _encode_webp_probe
+        quality, out_buf = estimate_quality(prepared, target_bytes, encode)
+        if quality is not None:
+            # re-encode the winner at full effort (Huffman optimize for
+            # JPEG, method=6 for WEBP); probes stay cheap
+            if pil_format == "JPEG":
+                final = encode_jpeg(prepared, quality, optimize=True)
             else:
-                high = mid - 1
-        if best:
-            return pad_file_to_size_safe(best, target_bytes)
+                final = encode_webp(prepared, quality, method=6)
+            if final.tell() <= target_bytes:
+                out_buf = final
+            return pad_file_to_size_safe(out_buf.getvalue(), target_bytes, pad=pad)
+    else:
+        # 2) Try high-quality save
+        img = src if is_pil else load_pil(src)
+        out_buf = save_with_format(img, pil_format, quality=90)
+        if out_buf.tell() <= target_bytes:
+            return pad_file_to_size_safe(out_buf.getvalue(), target_bytes, pad=pad)
 
-    # 3) Progressive resize
+    # 3) Resize toward the predicted scale
+    # Encoded size grows roughly linearly with pixel count, so jump straight
+    # to sqrt(target/current) instead of walking down in 0.9 steps.
     w, h = img.size
+    scale = min(0.95, math.sqrt(target_bytes / out_buf.tell()))
     while w > 50 and h > 50:
-        w = max(int(w * 0.9), 50)
-        h = max(int(h * 0.9), 50)
-        img = img.resize((w, h), Image.LANCZOS)
-        candidate = save_with_format(img, pil_format, quality=90)
-        if len(candidate) <= target_bytes:
-            return pad_file_to_size_safe(candidate, target_bytes)
+        w = max(int(w * scale), 50)
+        h = max(int(h * scale), 50)
+        img = _downscale(img, (w, h))
+        candidate = save_with_format(img, pil_format, quality=90, final=False)
+        if candidate.tell() <= target_bytes:
+            # winning size found; optimize only this one
+            best = save_with_format(img, pil_format, quality=90)
+            if best.tell() <= target_bytes:
+                candidate = best
+            return pad_file_to_size_safe(candidate.getvalue(), target_bytes, pad=pad)
+        scale = 0.9  # the predicted jump missed; refine with small steps
 
     # Best-effort
-    return pad_file_to_size_safe(out_bytes, target_bytes)
+    return pad_file_to_size_safe(out_buf.getvalue(), target_bytes, pad=pad)
 
-def _build_pdf_from_image_bytes(img_bytes: bytes, iw: int, ih: int, scale: float) -> bytes:
-    """
-    Place an image (already encoded) onto an A4 canvas at a given scale.
-    Returns PDF bytes.
+@st.cache_data(max_entries=8, show_spinner=False)
+def image_to_image_exact(data: bytes, out_fmt: str, target_bytes: int, pad: bool = False) -> bytes:
+    return _image_to_image_exact(data, out_fmt, target_bytes, pad)
+
+# A4 in PDF points
+PAGE_W, PAGE_H = 595.0, 842.0
+
+def wrap_jpeg_as_pdf(jpg_bytes, w: int, h: int, page_w: float = PAGE_W, page_h: float = PAGE_H) -> bytes:
+    """Wrap an encoded JPEG (bytes or memoryview) in a minimal single-page PDF.
+
+    PDF embeds JPEG natively as a DCTDecode image XObject, so the page is
+    just ~500 bytes of boilerplate around the untouched JPEG stream. No
+    canvas machinery, no re-sniffing the image — and the output size is
+    deterministic, which keeps the size searches honest.
     """
-    pw, ph = A4
-    draw_w = iw * scale
-    draw_h = ih * scale
-    x = (pw - draw_w) / 2
-    y = (ph - draw_h) / 2
+    draw_w, draw_h = float(w), float(h)
+    x = (page_w - draw_w) / 2
+    y = (page_h - draw_h) / 2
+    content = ("q %.2f 0 0 %.2f %.2f %.2f cm /Im0 Do Q" % (draw_w, draw_h, x, y)).encode("ascii")
 
-    buf = io.BytesIO()
-    c = canvas.Canvas(buf, pagesize=A4)
-    reader = ImageReader(io.BytesIO(img_bytes))
-    c.drawImage(reader, x, y, width=draw_w, height=draw_h, preserveAspectRatio=True, mask="auto")
-    c.showPage()
-    c.save()
-    return buf.getvalue()
-
-def image_to_pdf_exact(data: bytes, target_bytes: int) -> bytes:
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+        ("<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %.2f %.2f] "
+         "/Resources << /XObject << /Im0 4 0 R >> >> /Contents 5 0 R >>"
+         % (page_w, page_h)).encode("ascii"),
+        ("<< /Type /XObject /Subtype /Image /Width %d /Height %d "
+         "/ColorSpace /DeviceRGB /BitsPerComponent 8 /Filter /DCTDecode "
+         "/Length %d >>\nstream\n" % (w, h, len(jpg_bytes))).encode("ascii")
+        + jpg_bytes + b"\nendstream",
+        b"<< /Length %d >>\nstream\n" % len(content) + content + b"\nendstream",
+    ]
+
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for num, body in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n" % num
+        out += body
+        out += b"\nendobj\n"
+    xref_pos = len(out)
+    out += b"xref\n0 %d\n" % (len(objects) + 1)
+    out += b"0000000000 65535 f \n"
+    for off in offsets:
+        out += b"%010d 00000 n \n" % off
+    out += b"trailer\n<< /Size %d /Root 1 0 R >>\n" % (len(objects) + 1)
+    out += b"startxref\n%d\n" % xref_pos
+    out += b"%%EOF\n"
+    return bytes(out)
+
+@st.cache_data(max_entries=8, show_spinner=False)
+def image_to_pdf_exact(data: bytes, target_bytes: int, pad: bool = False) -> bytes:
     """
     Create a single-page PDF from an image with **shrinking**:
-    - Try binary-search JPEG quality for the embedded image
-    - If still too large, downscale the image and try again
-    - Never truncate PDFs; pad to exact if under target
+    - Bisect the image scale; pick JPEG quality per probe via the size model
+    - Never truncate PDFs; pad=True pads an under-target result to exact size
     """
     # Load original image for dimensions
-    pil_img = Image.open(io.BytesIO(data))
+    pil_img = open_for_target(data, target_bytes)
+    pil_img = choose_initial_size(pil_img, target_bytes)
     orig_w, orig_h = pil_img.size
 
     # We’ll embed a JPEG version of the image into the PDF (good balance)
-    # Try scales from 1.0 down to ~0.3
-    for scale in [1.0, 0.9, 0.8, 0.7, 0.6, 0.5, 0.45, 0.4, 0.35, 0.3]:
-        # Resize for this scale (affects PDF size strongly)
+    def try_scale(scale: float):
+        """Build a PDF at this scale if it can fit target_bytes, else None."""
         w = max(int(orig_w * scale), 1)
         h = max(int(orig_h * scale), 1)
-        scaled_img = pil_img.resize((w, h), Image.LANCZOS)
-
-        # Binary search JPEG quality for the embedded image
-        low, high = 30, 95   # keep above 30 for acceptable visual quality
-        best_pdf = None
-
-        while low <= high:
-            mid = (low + high) // 2
-            # encode JPEG at this quality
-            jpg_bytes = save_with_format(scaled_img, "JPEG", quality=mid)
-            # make a PDF placing that JPEG at the same pixel scale
-            pdf_bytes = _build_pdf_from_image_bytes(jpg_bytes, w, h, scale=1.0)  # image already scaled
-            size = len(pdf_bytes)
-            if size <= target_bytes:
+        scaled_img = _downscale(pil_img, (w, h))
+
+        # The PDF wrapper overhead is deterministic, so the model can target
+        # the JPEG byte budget exactly.
+        prepared = prepare_for_jpeg(scaled_img)
+        # +16 covers the extra offset/length digits a real stream adds
+        overhead = len(wrap_jpeg_as_pdf(b"", w, h)) + 16
+
+        quality, jpg_buf = estimate_quality(prepared, target_bytes - overhead)
+        if quality is None:
+            return None
+        # image already scaled, so place at 1 point per pixel; getbuffer()
+        # hands the wrapper a view of the JPEG without copying it out first
+        pdf_bytes = wrap_jpeg_as_pdf(jpg_buf.getbuffer(), w, h)
+        if len(pdf_bytes) <= target_bytes:
+            return pdf_bytes
+        return None
+
+    # Larger scale -> larger PDF, so bisect scale in [0.3, 1.0] and keep the
+    # biggest scale that fits: ~6 probes instead of the old 10-step scan.
+    best_pdf = try_scale(1.0)
+    if best_pdf is None:
+        low, high = 0.3, 1.0
+        for _ in range(6):
+            mid = (low + high) / 2
+            pdf_bytes = try_scale(mid)
+            if pdf_bytes is not None:
                 best_pdf = pdf_bytes
-                low = mid + 1
+                low = mid
             else:
-                high = mid - 1
+                high = mid
 
-        if best_pdf:
-            # We got under target at this scale; pad to exact and return
-            return pad_file_to_size_safe(best_pdf, target_bytes, is_pdf=True)
+    if best_pdf:
+        # We got under target; pad to exact only if asked
+        return pad_file_to_size_safe(best_pdf, target_bytes, is_pdf=True, pad=pad)
 
-    # If we couldn’t get ≤ target even at smallest scale/quality, generate the smallest and pad
+    # If we couldn’t get ≤ target even at smallest scale/quality, generate the smallest
     # Make a very small, decent-quality fallback
-    fallback = pil_img.resize((max(orig_w // 3, 1), max(orig_h // 3, 1)), Image.LANCZOS)
-    jpg_bytes = save_with_format(fallback, "JPEG", quality=60)
-    pdf_bytes = _build_pdf_from_image_bytes(jpg_bytes, fallback.width, fallback.height, scale=1.0)
-    # If still larger, we must return as-is (never truncate). Otherwise pad.
+    fallback = _downscale(pil_img, (max(orig_w // 3, 1), max(orig_h // 3, 1)))
+    jpg_buf = save_with_format(fallback, "JPEG", quality=60)
+    pdf_bytes = wrap_jpeg_as_pdf(jpg_buf.getbuffer(), fallback.width, fallback.height)
+    # If still larger, we must return as-is (never truncate).
     if len(pdf_bytes) < target_bytes:
-        return pad_file_to_size_safe(pdf_bytes, target_bytes, is_pdf=True)
+        return pad_file_to_size_safe(pdf_bytes, target_bytes, is_pdf=True, pad=pad)
     return pdf_bytes  # larger but valid
 
-def pdf_to_pdf_exact(data: bytes, target_bytes: int) -> bytes:
-    """Pad PDF safely (never truncate)."""
-    return pad_file_to_size_safe(data, target_bytes, is_pdf=True)
-
-def pdf_to_image(data: bytes, out_fmt: str, target_bytes: int) -> bytes:
-    if not PDF2IMAGE_OK:
-        raise RuntimeError("pdf2image not installed. Run: pip install pdf2image")
-    pages = convert_from_bytes(
-        data, dpi=200, first_page=1, last_page=1,
-        poppler_path=POPPLER_PATH
-    )
-    if not pages:
-        raise RuntimeError("Could not render PDF page")
-    pil_img = pages[0]
-    return image_to_image_exact(_pil_to_bytes(pil_img, "PNG"), out_fmt, target_bytes)
+@st.cache_data(max_entries=8, show_spinner=False)
+def pdf_to_pdf_exact(data: bytes, target_bytes: int, pad: bool = False) -> bytes:
+    """Return the PDF as-is; pad=True pads up to target (never truncate)."""
+    return pad_file_to_size_safe(data, target_bytes, is_pdf=True, pad=pad)
 
-def _pil_to_bytes(img: Image.Image, fmt: str = "PNG") -> bytes:
-    buf = io.BytesIO()
-    img.save(buf, fmt)
-    return buf.getvalue()
+@st.cache_data(max_entries=8, show_spinner=False)
+def pdf_to_image(data: bytes, out_fmt: str, target_bytes: int, pad: bool = False) -> bytes:
+    if not PYMUPDF_OK:
+        raise RuntimeError("PyMuPDF not installed. Run: pip install pymupdf")
+    doc = pymupdf.open(stream=data, filetype="pdf")
+    if doc.page_count == 0:
+        raise RuntimeError("Could not render PDF page")
+    page = doc[0]
+    # Size the raster to the target instead of always rendering at 200 dpi:
+    # the ~10 pixels-per-byte budget gives the pixel count worth rasterizing,
+    # and the page dimensions (points, 72/inch) turn that into a dpi.
+    area_in = max((page.rect.width / 72.0) * (page.rect.height / 72.0), 1e-6)
+    dpi = int(math.sqrt(target_bytes * 10 / area_in))
+    dpi = max(72, min(200, dpi))
+    pix = page.get_pixmap(dpi=dpi)
+    pil_img = Image.frombytes("RGB", (pix.width, pix.height), pix.samples)
+    # hand the rendered page over directly; no PNG round-trip
+    return _image_to_image_exact(pil_img, out_fmt, target_bytes, pad)
 
 # ----------------- main run -----------------
 if run and uploaded:
-    data = uploaded.read()
+    # getvalue() hands back the upload buffer without the extra copy (and
+    # without the cursor-position pitfalls) of read()
+    data = uploaded.getvalue()
     target_bytes = int(target_kb) * KB
 
     try:
@@ -205,18 +468,18 @@ if run and uploaded:
         if in_mime.startswith("image") or ext_in in (".jpg", ".jpeg", ".png", ".webp", ".bmp", ".tiff", ".tif"):
             if out_type == "pdf":
                 st.info("Converting Image → PDF (shrinking to target)")
-                out_data = image_to_pdf_exact(data, target_bytes)
+                out_data = image_to_pdf_exact(data, target_bytes, pad)
             else:
                 st.info(f"Converting Image → {out_type.upper()}")
-                out_data = image_to_image_exact(data, out_type, target_bytes)
+                out_data = image_to_image_exact(data, out_type, target_bytes, pad)
 
         elif in_mime == "application/pdf" or ext_in == ".pdf":
             if out_type == "pdf":
-                st.info("Converting PDF → PDF (pad only; no truncation)")
-                out_data = pdf_to_pdf_exact(data, target_bytes)
+                st.info("Converting PDF → PDF (no truncation)")
+                out_data = pdf_to_pdf_exact(data, target_bytes, pad)
             else:
                 st.info("Converting PDF → Image")
-                out_data = pdf_to_image(data, out_type, target_bytes)
+                out_data = pdf_to_image(data, out_type, target_bytes, pad)
 
         else:
             st.error("Unsupported input file type")